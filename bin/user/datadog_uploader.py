@@ -16,15 +16,20 @@ names.
         station_name = ...
 
 """
-import numbers
-import queue
 import base64
-import re
+import collections
+import gzip
+import json
+import math
 import sys
-from distutils.version import StrictVersion
+import threading
+import time
 import http.client as http_client
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from typing import NamedTuple
 
-from datadog import initialize, api, statsd
+import requests
+from datadog import DogStatsd
 
 import weewx
 import weewx.restx
@@ -34,7 +39,23 @@ from weeutil.weeutil import to_bool, accumulateLeaves
 VERSION = "0.0.1"
 
 REQUIRED_WEEWX = "3.5.0"
-if StrictVersion(weewx.__version__) < StrictVersion(REQUIRED_WEEWX):
+
+
+def _version_tuple(version):
+    """Return the numeric (major, minor, patch) of versions like 4.10.2 or 5.0.0b1."""
+    parts = []
+    for part in version.split('.')[:3]:
+        digits = ''
+        for c in part:
+            if not c.isdigit():
+                break
+            digits += c
+        parts.append(int(digits or 0))
+    # so that 3.5 compares equal to 3.5.0
+    return tuple(parts + [0] * (3 - len(parts)))
+
+
+if _version_tuple(weewx.__version__) < _version_tuple(REQUIRED_WEEWX):
     raise weewx.UnsupportedFeature("weewx %s or greater is required, found %s"
                                    % (REQUIRED_WEEWX, weewx.__version__))
 
@@ -78,12 +99,44 @@ except ImportError:
         logmsg(syslog.LOG_ERR, msg)
 
 # observations that should be skipped when obs_to_upload is 'most'
-OBS_TO_SKIP = ['dateTime', 'interval', 'usUnits']
+OBS_TO_SKIP = frozenset(['dateTime', 'interval', 'usUnits'])
+
+# binding the records in the queue come from
+_LOOP = 0
+_ARCHIVE = 1
+
+# the v2 series endpoint rejects payloads larger than 5MiB once decompressed,
+# the 500KB compressed limit is far off given how repetitive the series are
+MAX_PAYLOAD_BYTES = 5000000
+
+# v2 series metric types
+METRIC_TYPE_COUNT = 1
+METRIC_TYPE_GAUGE = 3
+
+# weewx fields that hold an amount accumulated over the packet or record
+# period, everything else (including rainRate and dayRain) is a gauge
+METRIC_TYPE = {
+    'rain': METRIC_TYPE_COUNT,
+    'hail': METRIC_TYPE_COUNT,
+    'ET': METRIC_TYPE_COUNT,
+    'lightning_strike_count': METRIC_TYPE_COUNT,
+}
 
-MAX_SIZE = 1000000
+
+class Point(NamedTuple):
+    """A pending metric point, much smaller than the equivalent series dict."""
+    metric: str
+    type: int
+    ts: int
+    value: float
+    # seconds the value of a count point was accumulated over, 0 for gauges
+    interval: int = 0
 
 
 class Datadog(weewx.restx.StdRESTbase):
+
+    DEFAULT_MAX_BACKLOG = 1024
+
     def __init__(self, engine, cfg_dict):
         """This service recognizes standard restful options plus the following:
 
@@ -92,10 +145,13 @@ class Datadog(weewx.restx.StdRESTbase):
         Optional parameters:
 
         binding: options include "loop", "archive", or "loop,archive"
-        Default is archive
+        Default is archive. Loop packets are sent through DogStatsD.
+        Count fields (see METRIC_TYPE) come from archive records when bound,
+        from loop packets otherwise.
         """
         super(Datadog, self).__init__(engine, cfg_dict)
         loginf("service version is %s" % VERSION)
+        self._thread = None
         site_dict = weewx.restx.get_site_dict(cfg_dict, 'Datadog', 'api_key', 'app_key',
                                               'station_name')
         if site_dict is None:
@@ -120,8 +176,13 @@ class Datadog(weewx.restx.StdRESTbase):
         if isinstance(binding, list):
             binding = ','.join(binding)
         loginf('binding is %s' % binding)
+        # count fields are sent from a single binding, or they would be counted twice
+        site_dict['loop_counts'] = 'archive' not in binding.lower()
 
-        data_queue = queue.Queue()
+        # a deque is a lock free multi producer, single consumer queue under the
+        # GIL, when full the oldest records are dropped
+        data_queue = collections.deque(
+            maxlen=int(site_dict.get('max_backlog', self.DEFAULT_MAX_BACKLOG)))
         try:
             data_thread = DatadogThread(data_queue, **site_dict)
         except weewx.ViolatedPrecondition as e:
@@ -129,24 +190,37 @@ class Datadog(weewx.restx.StdRESTbase):
             return
         data_thread.start()
 
+        # loop packets and archive records share the same queue and thread
+        self._dq = data_queue
+        self._wake = data_thread.wake
+        self._thread = data_thread
         if 'loop' in binding.lower():
-            self.loop_queue = data_queue
-            self.loop_thread = data_thread
             self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
         if 'archive' in binding.lower():
-            self.archive_queue = data_queue
-            self.archive_thread = data_thread
             self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
 
     def new_loop_packet(self, event):
-        data = {'binding': 'loop'}
-        data.update(event.packet)
-        self.loop_queue.put(data)
+        # the packet is only read by DatadogThread, no need to copy it
+        self._dq.append((_LOOP, event.packet))
+        self._wake.set()
 
     def new_archive_record(self, event):
-        data = {'binding': 'archive'}
-        data.update(event.record)
-        self.archive_queue.put(data)
+        self._dq.append((_ARCHIVE, event.record))
+        self._wake.set()
+
+    def shutDown(self):
+        """Stop the thread, once it has posted what is still pending."""
+        if self._thread is not None and self._thread.is_alive():
+            # cut the retries and waits short, even before the thread gets to
+            # the None record, which is the signal to exit
+            self._thread.stop()
+            self._dq.append(None)
+            self._wake.set()
+            self._thread.join(20.0)
+            if self._thread.is_alive():
+                logerr("Unable to shut down %s thread" % self._thread.name)
+            else:
+                logdbg("Shut down %s thread." % self._thread.name)
 
 
 class DatadogThread(weewx.restx.RESTThread):
@@ -155,12 +229,22 @@ class DatadogThread(weewx.restx.RESTThread):
     """
 
     DEFAULT_PREFIX = 'weewx'
+    DEFAULT_API_HOST = 'https://api.datadoghq.com'
+    DEFAULT_STATSD_HOST = 'localhost'
+    DEFAULT_STATSD_PORT = 8125
     DEFAULT_POST_INTERVAL = 10
     DEFAULT_TIMEOUT = 60
     DEFAULT_MAX_TRIES = 3
     DEFAULT_RETRY_WAIT = 5
+    DEFAULT_BATCH_SIZE = 500
+    DEFAULT_BATCH_TIMEOUT = 2
+    DEFAULT_MAX_WORKERS = 4
+    DEFAULT_MAX_INFLIGHT = 8
+    # below the 20s Datadog.shutDown() waits for the thread
+    SHUTDOWN_TIMEOUT = 15
+    # how often a wait for a busy worker checks whether we're stopping
+    STOP_POLL_INTERVAL = 0.5
     DEFAULT_TAGS = []
-    CAMEL_CASE_PATTERN = re.compile(r'(?<!^)(?=[A-Z])')
 
     def __init__(self, queue, manager_dict,
                  api_key, app_key, station_name, api_host=None, tags=None, prefix=DEFAULT_PREFIX,
@@ -168,19 +252,31 @@ class DatadogThread(weewx.restx.RESTThread):
                  skip_upload=False, post_interval=DEFAULT_POST_INTERVAL,
                  max_backlog=sys.maxsize, stale=None, log_success=True,
                  log_failure=True, timeout=DEFAULT_TIMEOUT,
-                 max_tries=DEFAULT_MAX_TRIES, retry_wait=DEFAULT_RETRY_WAIT):
+                 max_tries=DEFAULT_MAX_TRIES, retry_wait=DEFAULT_RETRY_WAIT,
+                 batch_size=DEFAULT_BATCH_SIZE, batch_timeout=DEFAULT_BATCH_TIMEOUT,
+                 statsd_host=DEFAULT_STATSD_HOST, statsd_port=DEFAULT_STATSD_PORT,
+                 loop_counts=True,
+                 max_workers=DEFAULT_MAX_WORKERS, max_inflight=DEFAULT_MAX_INFLIGHT):
         """Initialize an instances of DatadogThread.
         :param api_key: datadog api key.
-        :param app_key: datadog app key.
+        :param app_key: datadog app key, not needed to post metrics.
         :param prefix: Graphite Queue Prefix.
         :param log_success: Log a successful post in the system log.
         :param log_failure: Log an unsuccessful post in the system log.
-        :param max_backlog: Max length of Queue before trimming. dft=sys.maxint
+        :param max_backlog: Unused here, Datadog bounds its queue with it.
         :param max_tries: How many times to try the post before giving up.
         :param stale: How old a record can be and still considered useful.
         :param post_interval: The interval in seconds between posts.
         :param timeout: How long to wait for the server to respond before fail.
         :param skip_upload: Debugging option to display data but do not upload.
+        :param batch_size: Max number of metrics sent in a single post, unless a
+            single record holds more.
+        :param batch_timeout: Max seconds a metric waits before being posted.
+        :param statsd_host: DogStatsD host receiving the loop packets metrics.
+        :param statsd_port: DogStatsD port receiving the loop packets metrics.
+        :param loop_counts: Send the count fields of loop packets.
+        :param max_workers: How many posts can be sent concurrently.
+        :param max_inflight: How many posts can be pending before blocking.
         """
         super(DatadogThread, self).__init__(
             queue,
@@ -198,63 +294,311 @@ class DatadogThread(weewx.restx.RESTThread):
 
         if tags is None:
             tags = self.DEFAULT_TAGS
+        elif isinstance(tags, str):
+            # Datadog joins the configured tags with commas
+            tags = [t.strip() for t in tags.split(',') if t.strip()]
 
         self.prefix = prefix
-        self.tags = tags
         self.skip_upload = weeutil.weeutil.to_bool(skip_upload)
-
+        self.batch_size = int(batch_size)
+        self.batch_timeout = float(batch_timeout)
+        self.pending_metrics = []
+        self.pending_bytes = 0
+        # set by the producers when they append to the queue
+        self.wake = threading.Event()
+        # weewx field name -> datadog metric name, or None for skipped fields
+        self._name_cache = {}
+
+        # build a new list, DEFAULT_TAGS is shared by all the instances
+        extra = []
         if latitude:
-            self.tags.append("latitude:%s" % latitude)
+            extra.append("latitude:%s" % latitude)
         if longitude:
-            self.tags.append("longitude:%s" % longitude)
-        if station_type:
-            self.tags.append("station_type:%s" % station_type)
+            extra.append("longitude:%s" % longitude)
         if station_type:
-            self.tags.append("altitude:%s" % altitude)
-
-        options = {
-            "api_key": api_key,
-            "app_key": app_key,
-            "host_name": station_name,
-            "api_host": api_host,
+            extra.append("station_type:%s" % station_type)
+        if altitude is not None:
+            extra.append("altitude:%s" % altitude)
+
+        # tags never change, freeze them once instead of on every post
+        self.tags = tuple(sys.intern(t) for t in list(tags) + extra)
+
+        if not api_host:
+            api_host = self.DEFAULT_API_HOST
+        if '://' not in api_host:
+            api_host = 'https://' + api_host
+        self.host_name = station_name
+        self._url = api_host.rstrip('/') + '/api/v2/series'
+        self._headers = {
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip',
+            'DD-API-KEY': api_key,
         }
-
-        initialize(**options)
+        # the resources and tags are the same for all the series, serialize them once
+        resources = [{'type': 'host', 'name': self.host_name}] if self.host_name else []
+        self._series_suffix = ',"resources":%s,"tags":%s}' % (
+            json.dumps(resources, separators=(',', ':')),
+            json.dumps(list(self.tags), separators=(',', ':')))
+        # estimated JSON size of a point, besides its metric name
+        self._point_bytes = 80 + len(self._series_suffix.encode('utf-8'))
+        # loop packets go through the local Datadog Agent, the metrics are
+        # attributed to the station rather than to the agent's host
+        self.loop_counts = weeutil.weeutil.to_bool(loop_counts)
+        statsd_tags = list(self.tags)
+        if self.host_name:
+            statsd_tags.append("host:%s" % self.host_name)
+        self._statsd = DogStatsd(host=statsd_host, port=int(statsd_port),
+                                 constant_tags=statsd_tags)
+
+        # posts are sent from a pool of workers, each keeping its own
+        # connection to the Datadog API alive between posts
+        self._local = threading.local()
+        self.max_inflight = max(int(max_inflight), 1)
+        self._pool = ThreadPoolExecutor(max_workers=max(int(max_workers), 1))
+        self._inflight = collections.deque()
+        # set by stop(), ends the retries and waits early
+        self._stopping = threading.Event()
+
+    @staticmethod
+    def _snake(key):
+        """Convert a camelCase weewx field name to snake_case."""
+        out = []
+        for c in key:
+            if c.isupper() and out:
+                out.append('_')
+            out.append(c.lower())
+        return ''.join(out)
+
+    def _metric_name(self, key):
+        if key in OBS_TO_SKIP:
+            return None
+        _key = self._snake(key)
+        if self.prefix:
+            _key = '.'.join([self.prefix, _key])
+        # Datadog would replace these characters with underscores anyway, doing it
+        # here means the name can be put in the JSON body without escaping
+        return ''.join([c if c.isalnum() or c in '._' else '_' for c in _key])
+
+    def _metric_names(self, record):
+        """Return the name cache, holding the names of all the keys in record."""
+        name_cache = self._name_cache
+        for key in record:
+            if key not in name_cache:
+                name_cache[key] = self._metric_name(key)
+        return name_cache
+
+    def _sendable(self, record):
+        """Return the (key, metric name, value) of the values of record to send.
+
+        Skipped fields, None, non numeric and non finite values are never sent.
+        """
+        name_cache = self._metric_names(record)
+        isfinite = math.isfinite
+        return [(k, name_cache[k], v) for k, v in record.items()
+                if (type(v) is float or type(v) is int) and name_cache[k] is not None
+                and isfinite(v)]
 
     def collect_metric(self, record):
-        metrics = list()
-        for key, value in record.items():
-            _key = self.CAMEL_CASE_PATTERN.sub('_', key).lower()
-
-            if self.prefix:
-                metric_name = '.'.join([self.prefix, _key])
-            else:
-                metric_name = _key
-
-            if value is None:
-                _value = 0.0
+        """Return the metrics of the record and their estimated JSON size."""
+        ts = int(record['dateTime'])
+        # archive records have their interval in minutes
+        interval = int((record.get('interval') or 0) * 60)
+        metric_type = METRIC_TYPE.get
+        metrics = [Point(name, metric_type(k, METRIC_TYPE_GAUGE), ts, v,
+                         interval if k in METRIC_TYPE else 0)
+                   for k, name, v in self._sendable(record)]
+        size = sum([len(p.metric) for p in metrics]) + len(metrics) * self._point_bytes
+
+        return metrics, size
+
+    def send_statsd(self, record):
+        """Send the metrics of the record to DogStatsD, over UDP."""
+        _statsd = self._statsd
+        for k, name, v in self._sendable(record):
+            if METRIC_TYPE.get(k) == METRIC_TYPE_COUNT:
+                if self.loop_counts:
+                    _statsd.increment(name, v)
             else:
-                _value = value
-
-            if not isinstance(value, numbers.Number):
+                _statsd.gauge(name, v)
+
+    def _get_session(self):
+        # requests.Session is not thread safe, use one per worker
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def serialize(self, metrics):
+        """Return the JSON series body of a list of Points."""
+        suffix = self._series_suffix
+        interval = '"interval":%d,'
+        # metric names are JSON safe, see _metric_name()
+        return b'{"series":[' + ','.join([
+            f'{{"metric":"{p.metric}","type":{p.type},'
+            f'{interval % p.interval if p.interval else ""}'
+            f'"points":[{{"timestamp":{p.ts},"value":{p.value}}}]{suffix}'
+            for p in metrics]).encode('utf-8') + b']}'
+
+    def send_metrics(self, metrics, tries=None):
+        """Post the metrics, trying at most tries times (dft=max_tries)."""
+        if tries is None:
+            tries = self.max_tries
+        data = gzip.compress(self.serialize(metrics), compresslevel=6)
+        cause = None
+        attempts = 0
+        for _count in range(tries):
+            if _count and self._stopping.wait(self.retry_wait):
+                # shutting down, don't hold weewx up with retries
+                break
+            attempts += 1
+            try:
+                _response = self._get_session().post(self._url, data=data, headers=self._headers,
+                                                     timeout=self.timeout)
+            except requests.RequestException as e:
+                cause = e
+                logdbg("Failed upload attempt %d: %s" % (_count + 1, cause))
                 continue
+            if 200 <= _response.status_code <= 299:
+                return
+            if _response.status_code == 413 and len(metrics) > 1:
+                # too large for the endpoint, split it rather than retrying it as is,
+                # both halves are posted with the tries left
+                _half = len(metrics) // 2
+                _tries = max(tries - _count - 1, 1)
+                errors = []
+                for _part in (metrics[:_half], metrics[_half:]):
+                    try:
+                        self.send_metrics(_part, _tries)
+                    except weewx.restx.FailedPost as e:
+                        errors.append("%d metrics: %s" % (len(_part), e))
+                if errors:
+                    raise weewx.restx.FailedPost("; ".join(errors))
+                return
+            if 400 <= _response.status_code <= 499 and _response.status_code != 429:
+                # the payload or the key is wrong, retrying won't help
+                raise weewx.restx.FailedPost("%s %s" % (_response.status_code, _response.text))
+            cause = "%s %s" % (_response.status_code, _response.text)
+            logdbg("Failed upload attempt %d: %s" % (_count + 1, cause))
+        raise weewx.restx.FailedPost("Failed upload after %d tries: %s" % (attempts, cause))
+
+    def flush(self):
+        """Hand all the pending metrics to a worker to be posted in a single request."""
+        self.reap()
+        metrics = self.pending_metrics
+        if not metrics:
+            return
+        self.pending_metrics = []
+        self.pending_bytes = 0
+        if len(self._inflight) >= self.max_inflight:
+            # all the workers are busy, wait for the oldest post unless stopping
+            oldest = self._inflight[0][0]
+            while not oldest.done() and not self._stopping.is_set():
+                wait_futures([oldest], timeout=self.STOP_POLL_INTERVAL)
+            self.reap()
+        self._inflight.append((self._pool.submit(self.send_metrics, metrics), len(metrics)))
+
+    def reap(self, until=None):
+        """Log the outcome of the finished posts, waiting for all of them up to until."""
+        while self._inflight:
+            if until is None and not self._inflight[0][0].done():
+                return
+            item = self._inflight.popleft()
+            self._log_post(*item)
+            if item is until:
+                return
+
+    def stop(self):
+        """Ask the thread to stop retrying and waiting, ahead of the None record."""
+        self._stopping.set()
+
+    def drain(self, timeout):
+        """Wait at most timeout seconds for the posts in flight, then abandon the others."""
+        wait_futures([future for future, _count in self._inflight], timeout=timeout)
+        abandoned = 0
+        while self._inflight:
+            future, count = self._inflight.popleft()
+            if future.done():
+                self._log_post(future, count)
+            else:
+                # posts not started yet won't be, cancel_futures needs python 3.9
+                future.cancel()
+                abandoned += count
+        self._pool.shutdown(wait=False)
+        if abandoned and self.log_failure:
+            logerr("Abandoned %d metrics not yet published at shutdown" % abandoned)
+
+    def _log_post(self, future, count):
+        try:
+            future.result()
+        except Exception as e:
+            if self.log_failure:
+                logerr("Failed to publish %d metrics: %s" % (count, e))
+        else:
+            if self.log_success:
+                loginf("Published %d metrics" % count)
 
-            metrics.append(
-                {'metric': metric_name, 'type': 'gauge', 'points': (record['dateTime'], _value)})
-
-        result = api.metrics.Metric.send(metrics=metrics, tags=self.tags)
+    def run_loop(self, dbmanager=None):
+        """Drain the queue, batching the metrics of several records in one post.
 
-    def process_record(self, record, dbmanager):
+        The batch is flushed when it reaches batch_size metrics, would grow over 90%
+        of MAX_PAYLOAD_BYTES, or when batch_timeout seconds elapsed since the last flush.
+        """
+        data_queue = self.queue
+        last_flush = time.monotonic()
+        while True:
+            remaining = self.batch_timeout - (time.monotonic() - last_flush)
+            self.wake.wait(max(remaining, 0))
+            # clear before draining, so an append racing with us sets it again
+            self.wake.clear()
+            while data_queue:
+                _item = data_queue.popleft()
+                # A None record is our signal to exit
+                if _item is None:
+                    self.stop()
+                    self.flush()
+                    self.drain(self.SHUTDOWN_TIMEOUT)
+                    return
+
+                _binding, _record = _item
+                # post_interval only throttles archive records, dropping loop packets
+                # would lose the amounts of their count fields
+                if _binding != _LOOP and self.skip_this_post(_record['dateTime']):
+                    continue
+
+                try:
+                    self.process_record(_record, dbmanager, _binding)
+                except Exception as e:
+                    if self.log_failure:
+                        logerr("Failed to process record %s: %s"
+                               % (weeutil.weeutil.timestamp_to_string(_record['dateTime']), e))
+
+                if len(self.pending_metrics) >= self.batch_size:
+                    self.flush()
+                    last_flush = time.monotonic()
+
+            if time.monotonic() - last_flush >= self.batch_timeout:
+                self.flush()
+                last_flush = time.monotonic()
+
+    def process_record(self, record, dbmanager, binding=_ARCHIVE):
 
         if self.skip_upload:
-            syslog.syslog(
-                syslog.LOG_DEBUG,
-                "datadog_uploader: skip_upload=True, skipping upload"
-            )
-        else:
-            # Get the full record by querying the database ...
-            _full_record = self.get_record(record, dbmanager)
-            self.collect_metric(_full_record)
+            logdbg("skip_upload=True, skipping upload")
+            return
+
+        # Get the full record by querying the database ...
+        _full_record = self.get_record(record, dbmanager)
+        if binding == _LOOP:
+            # loop packets are frequent and best effort, skip the HTTPS API
+            self.send_statsd(_full_record)
+            return
+        metrics, size = self.collect_metric(_full_record)
+        if len(self.pending_metrics) + len(metrics) > self.batch_size \
+                or self.pending_bytes + size > MAX_PAYLOAD_BYTES * 0.9:
+            # keep each post under batch_size and the endpoint limit
+            self.flush()
+        self.pending_metrics.extend(metrics)
+        self.pending_bytes += size
 
 
 # Use this hook to test the uploader:
@@ -298,17 +642,17 @@ if __name__ == "__main__":
 
     print("Using server-url of '%s'" % options.server_url)
 
-    queue = queue.Queue()
-    t = DatadogThread(queue,
+    data_queue = collections.deque()
+    t = DatadogThread(data_queue,
                       manager_dict=None,
                       api_key=options.api_key,
                       app_key=options.app_key,
                       host_name=options.host_name,
                       tags=options.tags)
-    queue.put({'dateTime': int(time.time() + 0.5),
-               'usUnits': weewx.US,
-               'outTemp': 32.5,
-               'inTemp': 75.8,
-               'outHumidity': 24})
-    queue.put(None)
+    data_queue.append((_ARCHIVE, {'dateTime': int(time.time() + 0.5),
+                               'usUnits': weewx.US,
+                               'outTemp': 32.5,
+                               'inTemp': 75.8,
+                               'outHumidity': 24}))
+    data_queue.append(None)
     t.run()